@@ -34,20 +34,61 @@ for the switch-on (e.g. when using a vacuum tube power amp).
 """
 import atexit
 import logging
-import signal
+import mmap
 import os
+import sched
+import selectors
+import shlex
+import signal
+import subprocess
 import sys
+import threading
 import time
 from configparser import ConfigParser
-from flask import Flask
+from types import MappingProxyType, SimpleNamespace
+from flask import Flask, jsonify
 from systemd.journal import JournalHandler
+from waitress import serve
 
 LOG = logging.getLogger('hifipowerd')
 CFG = ConfigParser(defaults=dict(auto_mode_in='PA8', onoff_button='PA3',
                                  relay_out_1='PA9', relay_out_2='PA10',
                                  shutdown_button='PA0', reboot_button='PA1',
                                  manual_mode_in='PA6', ready_led='PA7'))
-CFG.read('/etc/hifipowerd.conf')
+CONFIG_PATH = '/etc/hifipowerd.conf'
+# read-only copy of the configuration, so that the lookups
+# don't need to go through ConfigParser; updated by load_config()
+CONFIG = MappingProxyType(dict(CFG.defaults()))
+# channel name to GPIO id mapping, filled once by gpio_setup()
+CHANNELS = {}
+# system commands split into argument lists, filled once by command_setup()
+COMMANDS = {}
+# power sequence state machine: the lock guards the state transitions,
+# the pending delayed step means a sequence is in progress;
+# {token: (scheduler event, relay, state)},
+# the token identifies the step in run_step()
+POWER_LOCK = threading.RLock()
+PENDING = {}
+# delayed power sequence steps are run by one scheduler thread;
+# the event wakes it up whenever a new step is scheduled
+SCHEDULER_WAKEUP = threading.Event()
+# GPIO libraries are not guaranteed to be reentrant
+GPIO_LOCK = threading.Lock()
+# recently read GPIO states: {channel: (state, timestamp)}, guarded by
+# GPIO_LOCK; reads within the TTL (in seconds) share one GPIO access
+INPUT_CACHE = {}
+INPUT_CACHE_TTL = 0.1
+# button lines requested from the gpiochip, kept open while running
+BUTTON_LINES = []
+# power status page fragments
+STATUS_TEMPLATE = '{msg}<div>Main power is {main}<br>Amp power is {amp}</div>'
+OVERRIDE_MSG = ('<div>Manual override is on - '
+                'software control inactive.</div>')
+STATE_LABELS = ('OFF', 'ON')
+# GPIO pin level registers mapped from the SoC, if available,
+# and the level bit numbers of the pins that snapshot() reads
+GPIO_REGISTERS = None
+LEVEL_BITS = {}
 
 
 # Conditional platform-based imports
@@ -55,6 +96,8 @@ try:
     # use SUNXI as it gives the most predictable results
     from OPi import GPIO
     GPIO.setmode(GPIO.SUNXI)
+    # no /dev/gpiomem on the Orange Pi; only the GPIO library is used
+    GPIOMEM = None
     print('Using OPi.GPIO on an Orange Pi with the SUNXI numbering.')
 
 except ImportError:
@@ -62,151 +105,345 @@ except ImportError:
     # use BCM as it is the most conventional scheme here
     from RPi import GPIO
     GPIO.setmode(GPIO.BCM)
+    # BCM GPIO registers, pin levels are in GPLEV0 and GPLEV1 words
+    GPIOMEM, GPLEV0, GPLEV1 = '/dev/gpiomem', 0x34 // 4, 0x38 // 4
     print('Using RPi.GPIO on a Raspberry Pi with the BCM numbering.')
 
+try:
+    # libgpiod delivers the button edge events through the gpiochip
+    # character device, instead of a sysfs polling thread
+    import gpiod
+    # only the libgpiod v1 bindings API is supported,
+    # v2 bindings have a different one
+    if not hasattr(gpiod, 'LINE_REQ_EV_RISING_EDGE'):
+        gpiod = None
+except ImportError:
+    gpiod = None
+
+try:
+    # faster JSON serialization for the status API, if available;
+    # JSON providers need Flask 2.2 or newer
+    import orjson
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:
+    orjson = None
+
 
 ON, OFF = GPIO.HIGH, GPIO.LOW
+# bound once, saving the attribute lookups on every GPIO access
+GPIO_INPUT, GPIO_OUTPUT = GPIO.input, GPIO.output
 
 
-def webapi():
-    """JSON web API for communicating with the casting software."""
-    def index():
-        """Display front page"""
-        page = """<h1>Keritech Electronics AC-1 Audio Computer</h1><br>"""
-        return page
-
-    def status_json():
-        """Get or change the interface's current status."""
-        return dict(power_state=get_power_state(),
-                    auto_mode=auto_control_check(),
-                    manual_override=manual_override_check(),
-                    relay1=relay1(),
-                    relay2=relay2(),
-                    relay1_active=relay1_active(),
-                    relay2_active=relay2_active())
-
-
-    def out1_on():
-        """turn on the first relay"""
+if orjson is not None:
+    class OrjsonProvider(DefaultJSONProvider):
+        """Flask JSON provider serializing with orjson"""
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+
+def index():
+    """Display front page"""
+    page = """<h1>Keritech Electronics AC-1 Audio Computer</h1><br>"""
+    return page
+
+
+def status_json():
+    """Get or change the interface's current status."""
+    state = snapshot()
+    return jsonify(power_state=state.power_state,
+                   auto_mode=state.auto_mode,
+                   manual_override=state.manual_override,
+                   relay1=state.relay1,
+                   relay2=state.relay2,
+                   relay1_active=state.relay1_active,
+                   relay2_active=state.relay2_active)
+
+
+def out1_on():
+    """turn on the first relay"""
+    with POWER_LOCK:
+        # a manual switch overrides the sequence step for this relay
+        cancel_pending(relay1)
         relay1(ON)
-        return output_status()
+    return output_status()
 
-    def out1_off():
-        """turn off the first relay"""
+
+def out1_off():
+    """turn off the first relay"""
+    with POWER_LOCK:
+        # a manual switch overrides the sequence step for this relay
+        cancel_pending(relay1)
         relay1(OFF)
-        return output_status()
+    return output_status()
+
 
-    def out2_on():
-        """turn on the second relay"""
+def out2_on():
+    """turn on the second relay"""
+    with POWER_LOCK:
+        # a manual switch overrides the sequence step for this relay
+        cancel_pending(relay2)
         relay2(ON)
-        return output_status()
+    return output_status()
 
-    def out2_off():
-        """turn off the second relay"""
+
+def out2_off():
+    """turn off the second relay"""
+    with POWER_LOCK:
+        # a manual switch overrides the sequence step for this relay
+        cancel_pending(relay2)
         relay2(OFF)
-        return output_status()
-
-    def all_on():
-        """turn the power on sequentially"""
-        power_on()
-        return output_status()
-
-    def all_off():
-        """turn the power off sequentially"""
-        power_off()
-        return output_status()
-
-    def toggle():
-        """toggle power button-style"""
-        power_toggle()
-        return output_status()
-
-    def output_status():
-        """text message about both devices status"""
-        msg = ''
-        if get_power_state() == -1:
-            msg = '''<div>Manual override is on -
-                   software control inactive.</div>'''
-        main_pwr = 'ON' if relay1_active() else 'OFF'
-        amp_pwr = 'ON' if relay2_active() else 'OFF'
-        return f'''{msg}<div>Main power is {main_pwr}<br>
-                   Amp power is {amp_pwr}</div>'''
-
-    app = Flask('rpi2casterd')
-    app.route('/')(index)
-    app.route('/json')(status_json)
-    app.route('/power')(output_status)
-    app.route('/power/on')(all_on)
-    app.route('/power/off')(all_off)
-    app.route('/power/toggle')(toggle)
-    app.route('/power/1')(relay1_active)
-    app.route('/power/2')(relay2_active)
-    app.route('/power/1/on')(out1_on)
-    app.route('/power/1/off')(out1_off)
-    app.route('/power/2/on')(out2_on)
-    app.route('/power/2/off')(out2_off)
-    config = CFG.defaults()
-    app.run(config.get('address'), config.get('port'),
-            debug=config.get('debug_mode'))
+    return output_status()
+
+
+def all_on():
+    """turn the power on sequentially"""
+    power_on()
+    return output_status()
+
+
+def all_off():
+    """turn the power off sequentially"""
+    power_off()
+    return output_status()
+
+
+def toggle():
+    """toggle power button-style"""
+    power_toggle()
+    return output_status()
+
+
+def output_status():
+    """text message about both devices status"""
+    state = snapshot()
+    msg = OVERRIDE_MSG if state.power_state == -1 else ''
+    return STATUS_TEMPLATE.format(
+        msg=msg, main=STATE_LABELS[bool(state.relay1_active)],
+        amp=STATE_LABELS[bool(state.relay2_active)])
+
+
+def webapi():
+    """JSON web API for communicating with the casting software."""
+    # a production server with a thread pool, so that status polls
+    # don't have to wait for each other
+    serve(APP, host=CONFIG.get('address', '127.0.0.1'),
+          port=int(CONFIG.get('port', 5000)),
+          threads=int(CONFIG.get('worker_threads', 8)),
+          connection_limit=128, channel_timeout=30)
 
 
 def gpio_setup():
     """Reads the gpio definitions dictionary,
     sets the outputs and inputs accordingly."""
-    config = CFG.defaults()
-    def shutdown(*_):
-        """Shut the system down"""
-        led(blink=5)
-        command = config.get('shutdown_command', 'sudo poweroff')
-        os.system(command)
-
-    def reboot(*_):
-        """Restart the system"""
-        led(blink=5)
-        command = config.get('reboot_command', 'sudo reboot')
-        os.system(command)
-
-    def finish(*_):
-        """Blink a LED and then clean the GPIO"""
-        led(OFF, blink=5, duration=5)
-        relay1(OFF)
-        relay2(OFF)
-        GPIO.cleanup()
-
-    # run the finish function when program ends e.g. during shutdown
+    # look up the GPIO ids once, so that the handlers don't need to
+    # go through the ConfigParser machinery on every GPIO access
+    CHANNELS.update((name, CONFIG.get(name))
+                    for name in ('onoff_button', 'shutdown_button',
+                                 'reboot_button', 'auto_mode_in',
+                                 'manual_mode_in', 'relay_out_1',
+                                 'relay_out_2', 'ready_led'))
+
+    # run the finish function when program ends e.g. during shutdown;
+    # unregister first so that it's registered only once
+    atexit.unregister(finish)
     atexit.register(finish)
 
-    # input configuration
-    inputs = [('onoff_button', power_toggle),
-              ('shutdown_button', shutdown),
-              ('reboot_button', reboot),
-              ('auto_mode_in', None),
-              ('manual_mode_in', None)]
-
-    for (gpio_name, callback) in inputs:
-        gpio_id = config.get(gpio_name)
+    # input configuration: buttons with their actions,
+    # and mode sense inputs which are only read on demand
+    buttons = [('onoff_button', power_toggle),
+               ('shutdown_button', shutdown),
+               ('reboot_button', reboot)]
+    for gpio_name in ('auto_mode_in', 'manual_mode_in'):
+        GPIO.setup(CHANNELS[gpio_name], GPIO.IN)
+
+    # with libgpiod, request rising edge event lines for the buttons
+    # on one gpiochip; one thread waits for the events on all of them
+    chip, selector = None, selectors.EpollSelector()
+    chip_name = CONFIG.get('gpio_chip', 'gpiochip0')
+    if gpiod is not None:
+        try:
+            chip = gpiod.Chip(chip_name)
+        except OSError as exc:
+            LOG.warning('Cannot open %s, using GPIO library events: %s',
+                        chip_name, exc)
+
+    for (gpio_name, callback) in buttons:
+        gpio_id = CHANNELS[gpio_name]
+        offset = line_offset(gpio_id)
+        if chip is not None and offset < chip.num_lines():
+            line = chip.get_line(offset)
+            try:
+                line.request(consumer='hifipowerd',
+                             type=gpiod.LINE_REQ_EV_RISING_EDGE)
+            except OSError as exc:
+                # e.g. the line is busy, still exported in sysfs
+                LOG.warning('Cannot request %s (%s) on %s, '
+                            'using GPIO library events: %s',
+                            gpio_name, gpio_id, chip_name, exc)
+            else:
+                BUTTON_LINES.append(line)
+                selector.register(line.event_get_fd(), selectors.EVENT_READ,
+                                  (line, callback))
+                continue
+        elif chip is not None:
+            # e.g. SUNXI PL pins are on a separate gpiochip (r_pio)
+            LOG.warning('%s (%s) is not on %s, using GPIO library events',
+                        gpio_name, gpio_id, chip_name)
         GPIO.setup(gpio_id, GPIO.IN)
         # add a threaded callback on this GPIO
-        if callback is not None:
-            GPIO.add_event_detect(gpio_id, GPIO.RISING, callback=callback)
+        GPIO.add_event_detect(gpio_id, GPIO.RISING, callback=callback)
+
+    if selector.get_map():
+        threading.Thread(target=watch_buttons, args=(selector,),
+                         daemon=True).start()
 
     # output configuration
-    GPIO.setup(config.get('relay_out_1'), GPIO.OUT, initial=OFF)
-    GPIO.setup(config.get('relay_out_2'), GPIO.OUT, initial=OFF)
-    GPIO.setup(config.get('ready_led'), GPIO.OUT, initial=ON)
+    GPIO.setup(CHANNELS['relay_out_1'], GPIO.OUT, initial=OFF)
+    GPIO.setup(CHANNELS['relay_out_2'], GPIO.OUT, initial=OFF)
+    GPIO.setup(CHANNELS['ready_led'], GPIO.OUT, initial=ON)
+
+    # read the pin levels straight from the registers if possible
+    gpiomem_setup()
+
+
+def gpiomem_setup():
+    """Maps the GPIO registers, so that snapshot() can read all the pin
+    levels at once. If this is not possible, GPIO library is used."""
+    global GPIO_REGISTERS
+    if GPIOMEM is None:
+        return
+    try:
+        memory_fd = os.open(GPIOMEM, os.O_RDONLY | os.O_SYNC)
+        try:
+            registers = mmap.mmap(memory_fd, mmap.PAGESIZE,
+                                  mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            os.close(memory_fd)
+    except OSError as exc:
+        LOG.info('Cannot map %s, reading GPIO via library: %s',
+                 GPIOMEM, exc)
+        return
+    LEVEL_BITS.update((name, line_offset(CHANNELS[name]))
+                      for name in ('auto_mode_in', 'manual_mode_in',
+                                   'relay_out_1', 'relay_out_2'))
+    # 32-bit register access
+    GPIO_REGISTERS = memoryview(registers).cast('I')
+
+
+def line_offset(gpio_id):
+    """Get the gpiochip line offset for a GPIO id.
+    SUNXI pin names (e.g. PA3) have 32 lines per bank,
+    BCM numbers are the line offsets already.
+    Only the pins of the first gpiochip are numbered this way;
+    SUNXI PL* pins are on a separate gpiochip (r_pio)
+    and get offsets past its end."""
+    gpio_id = str(gpio_id).strip().upper()
+    if gpio_id.isdigit():
+        return int(gpio_id)
+    bank, number = gpio_id[1], gpio_id[2:]
+    return (ord(bank) - ord('A')) * 32 + int(number)
+
+
+def watch_buttons(selector):
+    """Wait for the button line events and run the callbacks"""
+    while True:
+        # blocks until the kernel reports an edge on any of the lines
+        for key, _ in selector.select():
+            line, callback = key.data
+            event = line.event_read()
+            try:
+                callback(event.source.offset())
+            except Exception:
+                # keep handling the other buttons
+                LOG.exception('Button callback failed')
+
+
+def load_config():
+    """Reads the configuration file. This is done on startup
+    rather than on import, so that importing the module is cheap."""
+    global CONFIG
+    CFG.read(CONFIG_PATH)
+    CONFIG = MappingProxyType(dict(CFG.defaults()))
+
+
+def command_setup():
+    """Reads the system commands from the configuration
+    and splits them into argument lists, so that they can be run
+    without spawning a shell."""
+    commands = dict(shutdown=('shutdown_command', 'sudo poweroff'),
+                    reboot=('reboot_command', 'sudo reboot'),
+                    pipewire_start=('pipewire_start_command',
+                                    'systemctl --user start pipewire.service'),
+                    pipewire_stop=('pipewire_stop_command',
+                                   'systemctl --user stop pipewire.service'))
+    COMMANDS.update((name, shlex.split(CONFIG.get(option, default)))
+                    for name, (option, default) in commands.items())
 
 
 def journald_setup():
     """Set up and start journald logging"""
-    debug_mode = CFG.defaults().get('debug_mode')
-    if debug_mode:
-        LOG.setLevel(logging.DEBUG)
-        LOG.addHandler(logging.StreamHandler(sys.stderr))
+    # debug_mode is a config flag e.g. yes/no, on/off, true/false, 1/0
+    debug_mode = CFG.BOOLEAN_STATES.get(
+        CONFIG.get('debug_mode', 'no').strip().lower(), False)
     journal_handler = JournalHandler()
     log_entry_format = '[%(levelname)s] %(message)s'
     journal_handler.setFormatter(logging.Formatter(log_entry_format))
-    LOG.setLevel(logging.INFO)
-    LOG.addHandler(journal_handler)
+    # the web server messages and errors go to the journal as well;
+    # waitress sets up a root stderr handler, which would duplicate
+    # the entries in the journal, so don't propagate to it
+    for logger in (LOG, logging.getLogger('waitress')):
+        if debug_mode:
+            logger.addHandler(logging.StreamHandler(sys.stderr))
+        logger.setLevel(logging.DEBUG if debug_mode else logging.INFO)
+        logger.addHandler(journal_handler)
+        logger.propagate = False
+
+
+def snapshot():
+    """Reads all the input and relay pins once, and derives the whole
+    device state from them:
+        auto_mode, manual_override - control mode inputs,
+        relay1, relay2 - relay output states,
+        relay1_active, relay2_active - whether the channels are powered,
+        power_state - as returned by get_power_state().
+    """
+    levels = read_levels()
+    if levels is None:
+        auto_mode = auto_control_check()
+        manual_override = manual_override_check()
+        out1, out2 = relay1(), relay2()
+    else:
+        auto_mode, manual_override, out1, out2 = (
+            levels >> LEVEL_BITS[name] & 1
+            for name in ('auto_mode_in', 'manual_mode_in',
+                         'relay_out_1', 'relay_out_2'))
+    active1 = manual_override or auto_mode and out1
+    active2 = manual_override or auto_mode and out2
+    if not auto_mode:
+        power_state = -1
+    elif active2:
+        power_state = 2
+    elif active1:
+        power_state = 1
+    else:
+        power_state = 0
+    return SimpleNamespace(auto_mode=auto_mode,
+                           manual_override=manual_override,
+                           relay1=out1, relay2=out2,
+                           relay1_active=active1, relay2_active=active2,
+                           power_state=power_state)
+
+
+def read_levels():
+    """Reads all the GPIO pin levels from the registers at once,
+    and returns them as an int with pin N level at bit N.
+    Returns None if the registers are not mapped."""
+    if GPIO_REGISTERS is None:
+        return None
+    return GPIO_REGISTERS[GPLEV0] | GPIO_REGISTERS[GPLEV1] << 32
 
 
 def get_power_state():
@@ -214,30 +451,38 @@ def get_power_state():
     0 = off, 1 = main power ON but amp power OFF,
     2 = both main and amp power are ON.
     """
-    if not auto_control_check():
-        return -1
-    if relay2_active():
-        # stage 2
-        return 2
-    if relay1_active():
-        # stage 1
-        return 1
-    return 0
+    return snapshot().power_state
+
 
+def gpio_input(channel):
+    """Read the GPIO state, serializing the access to the GPIO library.
+    The state read less than INPUT_CACHE_TTL ago is reused."""
+    now = time.monotonic()
+    with GPIO_LOCK:
+        state, timestamp = INPUT_CACHE.get(channel, (None, None))
+        if timestamp is not None and now - timestamp < INPUT_CACHE_TTL:
+            return state
+        state = GPIO_INPUT(channel)
+        INPUT_CACHE[channel] = (state, now)
+        return state
 
-def get_channel(gpio_name):
-    """Get the GPIO number for a channel name"""
-    return CFG.defaults().get(gpio_name)
+
+def gpio_output(channel, state):
+    """Set the GPIO state, serializing the access to the GPIO library"""
+    with GPIO_LOCK:
+        GPIO_OUTPUT(channel, state)
+        # next read must get the new state
+        INPUT_CACHE.pop(channel, None)
 
 
 def auto_control_check():
     """Checks if the device is in the automatic/software control mode"""
-    return GPIO.input(get_channel('auto_mode_in'))
+    return gpio_input(CHANNELS['auto_mode_in'])
 
 
 def manual_override_check():
     """Checks if the device is in the manual override ON state"""
-    return GPIO.input(get_channel('manual_mode_in'))
+    return gpio_input(CHANNELS['manual_mode_in'])
 
 
 def relay1_active():
@@ -261,52 +506,128 @@ def relay2_active():
 def relay1(state=None):
     """Controls the state of the power relay - channel 1.
        If state is None, returns the current state."""
-    channel = get_channel('relay_out_1')
+    channel = CHANNELS['relay_out_1']
     if state is not None:
-        GPIO.output(channel, state)
-    return GPIO.input(channel)
+        gpio_output(channel, state)
+    return gpio_input(channel)
 
 
 def relay2(state=None):
     """Controls the state of the power relay - channel 2.
     If state is None, returns the current state."""
-    channel = get_channel('relay_out_2')
+    channel = CHANNELS['relay_out_2']
     if state is not None:
-        GPIO.output(channel, state)
-    return GPIO.input(channel)
+        gpio_output(channel, state)
+    return gpio_input(channel)
+
+
+def scheduler_delay(timeout):
+    """Wait until the next scheduled step is due,
+    or a new step is scheduled"""
+    SCHEDULER_WAKEUP.wait(timeout)
+    SCHEDULER_WAKEUP.clear()
+
+
+SCHEDULER = sched.scheduler(time.monotonic, scheduler_delay)
+
+
+def run_scheduler():
+    """Run the scheduled power sequence steps as they become due"""
+    while True:
+        SCHEDULER.run()
+        # nothing to do, wait for a new step
+        SCHEDULER_WAKEUP.wait()
+        SCHEDULER_WAKEUP.clear()
+
+
+def schedule(delay, relay, state):
+    """Set the relay state after a delay as the next step of a power
+    sequence, without blocking the caller.
+    Must be called with POWER_LOCK held."""
+    token = object()
+    event = SCHEDULER.enter(delay, 0, run_step, (token, relay, state))
+    PENDING[token] = (event, relay, state)
+    SCHEDULER_WAKEUP.set()
+
+
+def run_step(token, relay, state):
+    """Run the delayed step of a power sequence, completing it"""
+    with POWER_LOCK:
+        if PENDING.pop(token, None) is None:
+            # cancelled while this step was waiting for the lock
+            return
+        try:
+            relay(state)
+        except Exception:
+            # keep the scheduler thread running for the next steps
+            LOG.exception('Power sequence step failed')
+
+
+def pending_state():
+    """Get the state the power sequence in progress is switching to,
+    None if there is no sequence in progress.
+    Must be called with POWER_LOCK held."""
+    for (_, _, state) in PENDING.values():
+        return state
+    return None
+
+
+def cancel_pending(relay=None):
+    """Cancel the delayed steps of the power sequence in progress,
+    only those for the specified relay if it's not None.
+    Must be called with POWER_LOCK held."""
+    for token, (event, step_relay, _) in list(PENDING.items()):
+        if relay is not None and step_relay is not relay:
+            continue
+        del PENDING[token]
+        try:
+            SCHEDULER.cancel(event)
+        except ValueError:
+            # already taken off the queue, run_step() will skip it
+            pass
 
 
 def power_on():
     """Turns the hifi system on, main output first, amp output after 5s"""
-    power_state = get_power_state()
-    if power_state == 1:
-        # turn on the amps right away
-        relay2(ON)
-    elif power_state == 0:
-        # turn on the main gear, wait 5s, turn on the amps
-        relay1(ON)
-        time.sleep(5)
-        relay2(ON)
-    else:
-        # either fully on or manual control = do nothing
-        return
+    with POWER_LOCK:
+        if pending_state() == ON:
+            # already powering on, let the sequence complete
+            return
+        power_state = get_power_state()
+        if power_state not in (0, 1):
+            # either fully on or manual control = do nothing
+            return
+        # stop the power off sequence, if any, and go from where it was
+        cancel_pending()
+        if power_state == 1:
+            # turn on the amps right away
+            relay2(ON)
+        else:
+            # turn on the main gear, turn on the amps 5s later
+            relay1(ON)
+            schedule(5, relay2, ON)
 
 
 def power_off():
     """Turns the hifi system off, amp output first, then wait 15s
     and turn all the rest off"""
-    power_state = get_power_state()
-    if power_state == 2:
-        # full de-powering sequence
-        relay2(OFF)
-        time.sleep(15)
-        relay1(OFF)
-    elif power_state == 1:
-        # power off main only
-        relay1(OFF)
-    else:
-        # either powered off or manual mode, do nothing
-        return
+    with POWER_LOCK:
+        if pending_state() == OFF:
+            # already powering off, let the sequence complete
+            return
+        power_state = get_power_state()
+        if power_state not in (1, 2):
+            # either powered off or manual mode, do nothing
+            return
+        # stop the power on sequence, if any, and go from where it was
+        cancel_pending()
+        if power_state == 2:
+            # full de-powering sequence, main gear goes off 15s later
+            relay2(OFF)
+            schedule(15, relay1, OFF)
+        else:
+            # power off main only
+            relay1(OFF)
 
 
 def power_toggle(*_):
@@ -314,14 +635,16 @@ def power_toggle(*_):
     if it's partially ON (no amps, state 1), powers amps up;
     if it's fully OFF, powers both main and amps up.
     """
-    power_state = get_power_state()
-    if power_state < 0:
-        # auto control disabled, do nothing
-        return
-    if power_state == 2:
-        power_off()
-    elif get_power_state() < 2:
-        power_on()
+    # hold the lock so that the state can't change before acting on it
+    with POWER_LOCK:
+        power_state = get_power_state()
+        if power_state < 0:
+            # auto control disabled, do nothing
+            return
+        if power_state == 2:
+            power_off()
+        else:
+            power_on()
 
 
 def led(state=None, blink=0, duration=0.5):
@@ -329,49 +652,117 @@ def led(state=None, blink=0, duration=0.5):
         state - 0/1, True/False - sets the new state;
                 None preserves the previous one
         blink - number of LED blinks before the state is set
-        duration - total time of blinking in seconds"""
-    channel = get_channel('ready_led')
+        duration - total time of blinking in seconds
+    The blinking is done in a background thread, which is returned
+    so that the caller can wait for it if needed."""
+    channel = CHANNELS['ready_led']
     # preserve the previous state in case it is None
     if state is None:
-        state = GPIO.input(channel)
-    # each blink cycle has 2 timesteps,
-    # how long they are depends on the number of cycles and blinking duration
-    timestep = 0.5 * duration / (blink or 1)
-    # blinking a number of times
-    for _ in range(blink):
-        GPIO.output(channel, ON)
-        time.sleep(timestep)
-        GPIO.output(channel, OFF)
-        time.sleep(timestep)
-    # final state
-    GPIO.output(channel, state)
-
-
-def pw_control(state, config):
+        state = gpio_input(channel)
+
+    def blink_led():
+        """Blink the LED, then set its final state"""
+        # each blink cycle has 2 timesteps,
+        # how long they are depends on the number of cycles
+        # and blinking duration
+        timestep = 0.5 * duration / (blink or 1)
+        # blinking a number of times
+        for _ in range(blink):
+            gpio_output(channel, ON)
+            time.sleep(timestep)
+            gpio_output(channel, OFF)
+            time.sleep(timestep)
+        # final state
+        gpio_output(channel, state)
+
+    thread = threading.Thread(target=blink_led, daemon=True)
+    thread.start()
+    return thread
+
+
+def shutdown(*_):
+    """Shut the system down"""
+    led(blink=5)
+    subprocess.Popen(COMMANDS['shutdown'], close_fds=True)
+
+
+def reboot(*_):
+    """Restart the system"""
+    led(blink=5)
+    subprocess.Popen(COMMANDS['reboot'], close_fds=True)
+
+
+def finish(*_):
+    """Blink a LED and then clean the GPIO"""
+    # it's done now, so don't run it again at exit
+    atexit.unregister(finish)
+    blinking = led(OFF, blink=5, duration=5)
+    with POWER_LOCK:
+        # the relays must stay off
+        cancel_pending()
+        relay1(OFF)
+        relay2(OFF)
+    # the LED must be done before its GPIO is released
+    blinking.join()
+    GPIO.cleanup()
+
+
+def pw_control(state):
     """starts or stops the pipewire daemon whenever the power
     relay goes on or off, or the web service demands it"""
-    if state:
-        command = config.get('pipewire_start_command',
-                             'systemctl --user start pipewire.service')
-    else:
-        command = config.get('pipewire_stop_command',
-                             'systemctl --user stop pipewire.service')
-    os.system(command)
+    command = COMMANDS['pipewire_start' if state else 'pipewire_stop']
+    # wait for systemctl so that the start and stop requests are ordered
+    subprocess.run(command, check=False, close_fds=True)
+
+
+# web API routes: (path, handler)
+ROUTES = [('/', index),
+          ('/json', status_json),
+          ('/power', output_status),
+          ('/power/on', all_on),
+          ('/power/off', all_off),
+          ('/power/toggle', toggle),
+          ('/power/1', relay1_active),
+          ('/power/2', relay2_active),
+          ('/power/1/on', out1_on),
+          ('/power/1/off', out1_off),
+          ('/power/2/on', out2_on),
+          ('/power/2/off', out2_off)]
+
+# the web API app is built once, at import
+APP = Flask('hifipowerd')
+APP.url_map.strict_slashes = False
+if orjson is not None:
+    APP.json = OrjsonProvider(APP)
+for (path, handler) in ROUTES:
+    APP.add_url_rule(path, handler.__name__, handler)
 
 
 def main():
     """Main function"""
     # signal handling routine
     def signal_handler(*_):
-        """Exit gracefully if SIGINT or SIGTERM received"""
+        """Exit gracefully if SIGINT, or SIGTERM during startup received"""
         raise KeyboardInterrupt
 
+    def terminate(*_):
+        """Clean up right away and exit if SIGTERM received
+        e.g. when systemd stops the service"""
+        finish()
+        sys.exit(0)
+
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
     # get the GPIO definitions and set up the I/O
+    load_config()
     journald_setup()
+    command_setup()
     gpio_setup()
+    # finish() can only clean up once the GPIO is set up
+    signal.signal(signal.SIGTERM, terminate)
+    # run the delayed power sequence steps in the background
+    threading.Thread(target=run_scheduler, daemon=True).start()
     # start the webapi loop
     webapi()
 